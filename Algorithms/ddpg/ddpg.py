@@ -54,7 +54,7 @@ class DDPG:
             max_ep_len (int): Maximum length of trajectory / episode / rollout.
             logger_kwargs (dict): Keyword args for Logger. 
                         (1) output_dir = None
-                        (2) output_fname = 'progress.pickle'
+                        (2) output_fname = 'progress.npz'
             save_freq (int): How often (in terms of gap between episodes) to save
                 the current policy and value function.
         '''
@@ -115,7 +115,7 @@ class DDPG:
         terminals = terminals.to(self.device)
 
         # --------------------- Optimizing critic ---------------------
-        self.q_optimizer.zero_grad()
+        self.q_optimizer.zero_grad(set_to_none=True)
         # calculating q loss
         Q_values = self.ac.q(states, actions)
         with torch.no_grad():
@@ -135,7 +135,7 @@ class DDPG:
         for p in self.ac.q.parameters():
             p.requires_grad = False
 
-        self.pi_optimizer.zero_grad()
+        self.pi_optimizer.zero_grad(set_to_none=True)
         loss_pi = -self.ac.q(states, self.ac.pi(states)).mean()
         loss_pi.backward()
         self.pi_optimizer.step()
@@ -62,7 +62,7 @@ class TD3:
             max_ep_len (int): Maximum length of trajectory / episode / rollout.
             logger_kwargs (dict): Keyword args for Logger. 
                         (1) output_dir = None
-                        (2) output_fname = 'progress.pickle'
+                        (2) output_fname = 'progress.npz'
             save_freq (int): How often (in terms of gap between episodes) to save
                     the current policy and value function.
             policy_delay (int): Policy will only be updated once every 
@@ -127,7 +127,7 @@ class TD3:
         terminals = terminals.to(self.device)
 
         # --------------------- Optimizing critic ---------------------
-        self.q_optimizer.zero_grad()
+        self.q_optimizer.zero_grad(set_to_none=True)
         # calculating q loss
         q1 = self.ac.q1(states, actions)
         q2 = self.ac.q2(states, actions)
@@ -160,7 +160,7 @@ class TD3:
             for p in chain(self.ac.q1.parameters(), self.ac.q2.parameters()):
                 p.requires_grad = False
 
-            self.pi_optimizer.zero_grad()
+            self.pi_optimizer.zero_grad(set_to_none=True)
             loss_pi = -self.ac.q1(states, self.ac.pi(states)).mean()
             loss_pi.backward()
             self.pi_optimizer.step()
@@ -1,3 +1,4 @@
+import math
 import numpy as np
 import torch.nn as nn
 import torch
@@ -22,6 +23,28 @@ def mlp(sizes, activation, output_activation=nn.Identity):
         layers += [nn.Linear(sizes[j], sizes[j+1]), act()]
     return nn.Sequential(*layers)
 
+@torch.jit.script
+def gaussian_sample(mu, log_std):
+    '''
+    Sample an action from N(mu, exp(log_std)) together with its log likelihood (summed over the last axis),
+    scripted so the rollout doesn't construct a torch.distributions object every step
+    '''
+    eps = torch.randn_like(mu)
+    a = mu + torch.exp(log_std) * eps
+    logp_a = (-0.5 * eps.pow(2) - log_std - 0.5 * math.log(2 * math.pi)).sum(-1)
+    return a, logp_a
+
+@torch.jit.script
+def categorical_sample(logits):
+    '''
+    Sample an action from Categorical(logits) together with its log likelihood,
+    scripted so the rollout doesn't construct a torch.distributions object every step
+    '''
+    logp = torch.log_softmax(logits, -1)
+    a = torch.multinomial(logp.exp(), 1)
+    logp_a = logp.gather(-1, a).squeeze(-1)
+    return a.squeeze(-1), logp_a
+
 class MLPCritic(nn.Module):
     '''
     A value network for the critic of trpo
@@ -55,6 +78,21 @@ class Actor(nn.Module):
     def _log_prob_from_distribution(self, pi, act):
         raise NotImplementedError
 
+    def _sample(self, obs):
+        raise NotImplementedError
+
+    def _kl_from_distribution(self, pi_old, pi):
+        raise NotImplementedError
+
+    def calculate_kl(self, old_policy, new_policy, obs):
+        '''
+        Mean KL divergence D( pi_old || pi_new ) over a batch of observations,
+        the old policy distribution is treated as a constant
+        '''
+        with torch.no_grad():
+            pi_old = old_policy._distribution(obs)
+        return self._kl_from_distribution(pi_old, new_policy._distribution(obs))
+
     def forward(self, obs, act=None):
         '''
         Produce action distributions for given observations, and 
@@ -85,7 +123,13 @@ class MLPCategoricalActor(Actor):
     
     def _distribution(self, obs):
         logits = self.logits_net(obs)
-        return Categorical(logits=logits)
+        return Categorical(logits=logits, validate_args=False)
+
+    def _sample(self, obs):
+        '''
+        Sample an action and its log likelihood without building the distribution
+        '''
+        return categorical_sample(self.logits_net(obs))
     
     def _log_prob_from_distribution(self, pi, act):
         '''
@@ -95,25 +139,16 @@ class MLPCategoricalActor(Actor):
         '''
         return pi.log_prob(act)
 
-    def calculate_kl(self, old_policy, new_policy, obs):
-        """
-        tf symbol for mean KL divergence between two batches of categorical probability distributions,
-        where the distributions are input as log probs.
-        """
-        # _, logp0 = old_policy(obs, act)
-        # logp0 = logp0.detach()
-        # _, logp1 = new_policy(obs, act)
-
-        p0 = old_policy._distribution(obs).probs.detach() + 1e-8
-        p1 = new_policy._distribution(obs).probs
-        # pi_new = Categorical(old_policy.logits_net(obs))
-        # act_new = pi_new.sample()
-        # logp0 = old_policy._log_prob_from_distribution(pi_old, act_old)
-        # logp1 = new_policy._log_prob_from_distribution(pi_new, act_new)
-
-        return torch.sum(p0 * torch.log(p0 / p1), 1).mean()
-        # kl = torch.exp(logp1) * (logp1-logp0)
-        # return kl.sum(-1, keepdim=True).mean()
+    def _kl_from_distribution(self, pi_old, pi):
+        '''
+        Mean KL divergence between two batches of categorical distributions
+        Args:
+            pi_old: distribution of the old policy from _distribution() function
+            pi: distribution of the new policy from _distribution() function
+        '''
+        p0 = pi_old.probs + 1e-8
+        p1 = pi.probs
+        return torch.sum(p0 * torch.log(p0 / p1), -1).mean()
 
 class MLPGaussianActor(Actor):
     '''
@@ -136,7 +171,13 @@ class MLPGaussianActor(Actor):
     def _distribution(self, obs):
         mu = self.mu_net(obs)
         std = torch.exp(self.log_std)
-        return Normal(mu, std)
+        return Normal(mu, std, validate_args=False)
+
+    def _sample(self, obs):
+        '''
+        Sample an action and its log likelihood without building the distribution
+        '''
+        return gaussian_sample(self.mu_net(obs), self.log_std)
     
     def _log_prob_from_distribution(self, pi, act):
         '''
@@ -146,9 +187,15 @@ class MLPGaussianActor(Actor):
         '''
         return pi.log_prob(act).sum(axis=-1)    # last axis sum needed for Torch Normal Distribution
     
-    def calculate_kl(self, old_policy, new_policy, obs):
-        mu_old, std_old = old_policy.mu_net(obs).detach(), torch.exp(old_policy.log_std).detach()
-        mu, std = new_policy.mu_net(obs), torch.exp(new_policy.log_std)
+    def _kl_from_distribution(self, pi_old, pi):
+        '''
+        Mean KL divergence between two batches of diagonal gaussian distributions
+        Args:
+            pi_old: distribution of the old policy from _distribution() function
+            pi: distribution of the new policy from _distribution() function
+        '''
+        mu_old, std_old = pi_old.loc, pi_old.scale
+        mu, std = pi.loc, pi.scale
 
         # kl divergence between old policy and new policy : D( pi_old || pi_new )
         # (https://stats.stackexchange.com/questions/7440/kl-divergence-between-two-univariate-gaussians)
@@ -187,11 +234,17 @@ class MLPActorCritic(nn.Module):
     
     def step(self, obs):
         with torch.no_grad():
-            pi = self.pi._distribution(obs)
-            a = pi.sample()
-            logp_a = self.pi._log_prob_from_distribution(pi, a)
-            v = self.v(obs).detach().cpu().numpy()
-        return a.detach().cpu().numpy(), v, logp_a.cpu().detach().numpy()
+            a, logp_a = self.pi._sample(obs)
+            v = self.v(obs)
+        return a.cpu().numpy(), v.cpu().numpy(), logp_a.cpu().numpy()
 
     def act(self, obs):
-        return self.step(obs)[0]
\ No newline at end of file
+        return self.step(obs)[0]
+
+    def v_only(self, obs):
+        '''
+        Value estimate of obs from the critic alone, without sampling an action
+        '''
+        with torch.no_grad():
+            v = self.v(obs)
+        return v.cpu().numpy()
\ No newline at end of file
@@ -1,7 +1,7 @@
 import numpy as np
 import random
+import scipy.signal
 import torch
-from copy import deepcopy
 
 def combined_shape(length, shape=None):
     '''
@@ -25,12 +25,8 @@ def discount_cumsum(x, discount):
          x1 + discount * x2,
          x2]
     """
-    running_sum = 0
-    output = deepcopy(x)
-    for i in reversed(range(len(x))):
-        output[i] += running_sum*discount
-        running_sum = output[i]
-    return output
+    # y[t] = x[t] + discount * y[t+1] is a first order IIR filter over the reversed input
+    return scipy.signal.lfilter([1], [1, float(-discount)], x[::-1], axis=0)[::-1]
 
 class GAEBuffer:
     """
@@ -56,8 +52,11 @@ class GAEBuffer:
             gamma (float): discount factor for advantage estimation
             lam (float): lambda for advantage estimation
         '''
-        self.obs_buf = np.zeros(combined_shape(size, obs_dim), dtype=np.float32)
-        self.act_buf = np.zeros(combined_shape(size, act_dim), dtype=np.float32)
+        # On gpu the obs/act buffers are numpy views of pinned host memory,
+        # so get() can copy them to the device asynchronously
+        pin_memory = device == 'cuda'
+        self.obs_buf = torch.zeros(combined_shape(size, obs_dim), dtype=torch.float32, pin_memory=pin_memory).numpy()
+        self.act_buf = torch.zeros(combined_shape(size, act_dim), dtype=torch.float32, pin_memory=pin_memory).numpy()
         self.adv_buf = np.zeros(size, dtype=np.float32)
         self.rew_buf = np.zeros(size, dtype=np.float32)
         self.ret_buf = np.zeros(size, dtype=np.float32)
@@ -71,13 +70,14 @@ class GAEBuffer:
         """
         Append one timestep of agent-environment interaction to the buffer.
         """
-        assert self.ptr < self.max_size, f"{self.ptr}, {self.max_size}"      # Buffer has to have room so you can store
-        self.obs_buf[self.ptr] = obs
-        self.act_buf[self.ptr] = act
-        self.rew_buf[self.ptr] = rew
-        self.val_buf[self.ptr] = val
-        self.logp_buf[self.ptr] = logp
-        self.ptr += 1
+        ptr = self.ptr
+        assert ptr < self.max_size, f"{ptr}, {self.max_size}"      # Buffer has to have room so you can store
+        self.obs_buf[ptr] = obs
+        self.act_buf[ptr] = act
+        self.rew_buf[ptr] = rew
+        self.val_buf[ptr] = val
+        self.logp_buf[ptr] = logp
+        self.ptr = ptr + 1
 
     def finish_path(self, last_val=0):
         """
@@ -115,10 +115,14 @@ class GAEBuffer:
         """
         assert self.ptr == self.max_size, f"{self.ptr}"     # Buffer has to be full before you can get
         self.ptr, self.path_start_idx = 0, 0
-        # The next line implement the advantage normalization trick to reduce variance
-        self.adv_buf = (self.adv_buf - self.adv_buf.mean()) / self.adv_buf.std()
-        return dict(obs=torch.Tensor(self.obs_buf).to(self.device),
-                    act=torch.Tensor(self.act_buf).to(self.device),
-                    ret=torch.Tensor(self.ret_buf).to(self.device),
-                    adv=torch.Tensor(self.adv_buf).to(self.device),
-                    logp=torch.Tensor(self.logp_buf).to(self.device))
\ No newline at end of file
+        # The next lines implement the advantage normalization trick to reduce variance
+        adv_mean, adv_std = self.adv_buf.mean(), self.adv_buf.std()
+        self.adv_buf -= adv_mean
+        self.adv_buf /= adv_std + 1e-8
+        # torch.from_numpy shares memory with the buffers, so the only copy is the one to self.device.
+        # obs is fed to every policy/value forward in the update, keep it contiguous
+        return dict(obs=torch.from_numpy(self.obs_buf).to(self.device, non_blocking=True).contiguous(),
+                    act=torch.from_numpy(self.act_buf).to(self.device, non_blocking=True),
+                    ret=torch.from_numpy(self.ret_buf).to(self.device),
+                    adv=torch.from_numpy(self.adv_buf).to(self.device),
+                    logp=torch.from_numpy(self.logp_buf).to(self.device))
\ No newline at end of file
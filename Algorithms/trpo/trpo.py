@@ -14,8 +14,25 @@ from gae_buffer import GAEBuffer
 # from Logger.logger import Logger
 from copy import deepcopy
 from torch import optim
+from torch.func import functional_call, grad, linearize
+from torch.nn.utils import parameters_to_vector, vector_to_parameters
 from tqdm import tqdm
 
+@torch.jit.script
+def v_loss_fn(v, ret):
+    '''
+    Mean squared error between the value estimates and the rewards-to-go
+    '''
+    return ((v-ret)**2).mean()
+
+@torch.jit.script
+def surrogate(logp, logp_old, adv):
+    '''
+    Surrogate advantage mean(π(a|s)/π_old(a|s) * A), averaged over the last dimension
+    so a batch of candidate policies [k, n] gives k surrogates
+    '''
+    return (torch.exp(logp - logp_old) * adv).mean(-1)
+
 class TRPO:
     
     def __init__(self, env_fn, actor_critic=MLPActorCritic, ac_kwargs=dict(), seed=0, 
@@ -63,7 +80,7 @@ class TRPO:
             max_ep_len (int): Maximum length of trajectory / episode / rollout.
             logger_kwargs (dict): Keyword args for Logger. 
                             (1) output_dir = None
-                            (2) output_fname = 'progress.pickle'
+                            (2) output_fname = 'progress.npz'
             save_freq (int): How often (in terms of gap between epochs) to save
                 the current policy and value function.
             algo: Either 'trpo' or 'npg': this code supports both, since they are 
@@ -75,7 +92,6 @@ class TRPO:
         torch.manual_seed(seed)
         np.random.seed(seed)
         self.device = "cuda" if torch.cuda.is_available() else "cpu"
-        self.device="cpu"
         self.env = env_fn()
         self.vf_lr = vf_lr
         self.steps_per_epoch = steps_per_epoch
@@ -86,8 +102,17 @@ class TRPO:
         # Main network
         self.ac = actor_critic(self.env.observation_space, self.env.action_space, device=self.device, **ac_kwargs)
 
+        # Compiled critic for the train_v_iters loop, which always sees a batch of steps_per_epoch observations.
+        # It shares parameters with self.ac.v, the uncompiled module is kept for the single observation rollout.
+        self.v_train = torch.compile(self.ac.v, mode='reduce-overhead', dynamic=False)
+        # Run the critic forward in bfloat16 during the value updates where the hardware supports it natively,
+        # the optimizer keeps the parameters in float32
+        self.v_bf16 = self.device == 'cuda' and torch.cuda.is_bf16_supported()
+
         # Create Optimizers
-        self.v_optimizer = optim.Adam(self.ac.v.parameters(), lr=self.vf_lr)
+        # fused Adam kernel on CUDA, multi-tensor (foreach) Adam otherwise
+        fused = self.device == 'cuda'
+        self.v_optimizer = optim.Adam(self.ac.v.parameters(), lr=self.vf_lr, fused=fused, foreach=not fused)
 
         # GAE buffer
         self.gamma = gamma
@@ -96,6 +121,13 @@ class TRPO:
         self.act_dim = self.env.action_space.shape
         self.buffer = GAEBuffer(self.obs_dim, self.act_dim, self.steps_per_epoch, self.device, self.gamma, self.lam)
 
+        # Preallocated observation tensors, filled in place at every environment step
+        self._obs_cpu = torch.empty(self.obs_dim, dtype=torch.float32, pin_memory=(self.device == 'cuda'))
+        self._obs_buf = self._obs_cpu if self.device == 'cpu' else torch.empty(self.obs_dim, dtype=torch.float32, device=self.device)
+        # Persistent output of get_action, self._act_tensor shares memory with self._act_out
+        self._act_out = np.empty(self.act_dim, dtype=self.env.action_space.dtype)
+        self._act_tensor = torch.from_numpy(self._act_out)
+
         self.cg_iters = cg_iters
         self.damping_coeff = damping_coeff
         self.delta = delta
@@ -103,70 +135,90 @@ class TRPO:
         self.algo = algo
         self.backtrack_iters = backtrack_iters
 
-    def flat_grad(self, grads, hessian=False):
+    def flat_grad(self, grads):
         grad_flatten = []
-        if hessian == False:
-            for grad in grads:
-                grad_flatten.append(grad.view(-1))
-            grad_flatten = torch.cat(grad_flatten)
-            return grad_flatten
-        elif hessian == True:
-            for grad in grads:
-                grad_flatten.append(grad.contiguous().view(-1))
-            grad_flatten = torch.cat(grad_flatten).data
-            return grad_flatten
-
-    def cg(self, obs, b, act, EPS=1e-8, residual_tol=1e-10):
+        for grad in grads:
+            grad_flatten.append(grad.view(-1))
+        return torch.cat(grad_flatten)
+
+    def unflatten_params(self, model, flat_params):
+        '''
+        Split a flat parameter vector into a {name: tensor} dict matching the model parameters,
+        in the format expected by torch.func.functional_call
+        '''
+        params = {}
+        index = 0
+        for name, param in model.named_parameters():
+            params_length = param.numel()
+            params[name] = flat_params[index: index + params_length].view(param.size())
+            index += params_length
+        return params
+
+    def cg(self, hvp, b, EPS=1e-8, residual_tol=1e-10):
         # Conjugate gradient algorithm
         # (https://en.wikipedia.org/wiki/Conjugate_gradient_method)
-        x = torch.zeros(b.size()).to(self.device)
+        x = torch.zeros_like(b)
         r = b.clone()
         p = r.clone()
-        rdotr = torch.dot(r, r).to(self.device)
-
-        for _ in range(self.cg_iters):
-            Ap = self.hessian_vector_product(obs, p)
-            alpha = rdotr / (torch.dot(p, Ap).to(self.device) + EPS)
-            
-            x += alpha * p
-            r -= alpha * Ap
-            
+        rdotr = torch.dot(r, r)
+
+        for i in range(self.cg_iters):
+            Ap = hvp(p)
+            alpha = rdotr / torch.dot(p, Ap).clamp_min(EPS)
+
+            # in-place x += alpha * p, r -= alpha * Ap, alpha stays on device as a 0-dim tensor
+            x.addcmul_(alpha, p)
+            r.addcmul_(alpha, Ap, value=-1)
+
             new_rdotr = torch.dot(r, r)
-            p = r + (new_rdotr / rdotr) * p
+            p.mul_(new_rdotr / rdotr).add_(r)
             rdotr = new_rdotr
 
-            if rdotr < residual_tol:
+            # the residual check synchronizes with the device, only do it every 2 iterations
+            if i % 2 == 1 and rdotr.item() < residual_tol:
                 break
 
         return x
 
 
-    def hessian_vector_product(self, obs, p):
-        p = p.detach()
-        kl = self.ac.pi.calculate_kl(old_policy=self.ac.pi, new_policy=self.ac.pi, obs=obs)
-        kl_grad = torch.autograd.grad(kl, self.ac.pi.parameters(), create_graph=True)
-        kl_grad = self.flat_grad(kl_grad)
+    def hessian_vector_product(self, obs):
+        '''
+        Build the Hessian-vector product function of the KL divergence w.r.t. the policy parameters.
+        The forward and first backward pass of the KL are linearized once at the current parameters,
+        so each call of the returned function only replays the tangent (jvp) pass.
+        Args:
+            obs (Tensor [n, obs_dim]): batch of observation from environment
+        Return:
+            hvp (function): maps a flat vector p to (H + damping_coeff * I)p
+        '''
+        with torch.no_grad():
+            pi_old = self.ac.pi._distribution(obs)
 
-        kl_grad_p = (kl_grad * p).sum() 
-        kl_hessian = torch.autograd.grad(kl_grad_p, self.ac.pi.parameters())
-        kl_hessian = self.flat_grad(kl_hessian, hessian=True)
-        return kl_hessian + p * self.damping_coeff
+        def kl_fn(flat_params):
+            pi, _ = functional_call(self.ac.pi, self.unflatten_params(self.ac.pi, flat_params), (obs,))
+            return self.ac.pi._kl_from_distribution(pi_old, pi)
 
-    def flat_params(self, model):
-        params = []
-        for param in model.parameters():
-            params.append(param.data.view(-1))
-        params_flatten = torch.cat(params)
-        return params_flatten
+        params = parameters_to_vector(self.ac.pi.parameters()).detach()
+        _, kl_hessian = linearize(grad(kl_fn), params)
 
-    def update_model(self, model, new_params):
-        index = 0
-        for params in model.parameters():
-            params_length = len(params.view(-1))
-            new_param = new_params[index: index + params_length]
-            new_param = new_param.view(params.size())
-            params.data.copy_(new_param)
-            index += params_length
+        def hvp(p):
+            p = p.detach()
+            return kl_hessian(p) + p * self.damping_coeff
+        return hvp
+
+    def obs_to_tensor(self, obs):
+        '''
+        Copy an observation into the preallocated observation tensor on self.device.
+        The returned tensor is overwritten by the next call.
+        Args:
+            obs (numpy ndarray): Current state of the environment
+        Return:
+            obs (Tensor [obs_dim]): Current state of the environment on self.device
+        '''
+        self._obs_cpu.copy_(torch.from_numpy(np.asarray(obs)))
+        if self._obs_buf is not self._obs_cpu:
+            self._obs_buf.copy_(self._obs_cpu, non_blocking=True)
+        return self._obs_buf
 
     def get_action(self, obs):
         '''
@@ -174,11 +226,12 @@ class TRPO:
         Args:
             obs (numpy ndarray): Current state of the environment
         Return:
-            Action (numpy ndarray): Scaled action that is clipped to environment's action limits
+            Action (numpy ndarray): Action sampled from the policy, the array is overwritten by the next call
         '''
-        obs = torch.as_tensor(obs, dtype=torch.float32).to(self.device)
-        action = self.ac.act(obs)
-        return action.detach().cpu().numpy()
+        with torch.no_grad():
+            action, _ = self.ac.pi._sample(self.obs_to_tensor(obs))
+        self._act_tensor.copy_(action)
+        return self._act_out
 
     def update(self):
         data = self.buffer.get()
@@ -187,77 +240,69 @@ class TRPO:
         ret = data['ret']
         adv = data['adv']
         logp_old = data['logp']
+        assert obs.is_contiguous(), "obs has to be contiguous for the policy/value forward passes"
 
         # Prediction logπ_old(s), logπ(s)
         _, logp = self.ac.pi(obs, act)
         
         # Policy loss
-        ratio_old = torch.exp(logp - logp_old)
-        surrogate_adv_old = (ratio_old*adv).mean()
+        surrogate_adv_old = surrogate(logp, logp_old, adv)
         
         # policy gradient calculation as per algorithm, flatten to do matrix calculations later
         gradient = torch.autograd.grad(surrogate_adv_old, self.ac.pi.parameters()) # calculate gradient of policy loss w.r.t to policy parameters
         gradient = self.flat_grad(gradient)
 
         # Core calculations for NPG/TRPO
-        search_dir = self.cg(obs, gradient.data, act)    # H^-1 g
-        gHg = (self.hessian_vector_product(obs, search_dir, act) * search_dir).sum(0)
+        hvp = self.hessian_vector_product(obs)
+        search_dir = self.cg(hvp, gradient.data)    # H^-1 g
+        # H search_dir ≈ g by construction of cg, so g^T H^-1 g = search_dir^T g without another Hessian-vector product
+        gHg = torch.dot(search_dir, gradient).clamp_min(1e-8)
         step_size = torch.sqrt(2 * self.delta / gHg)
-        old_params = self.flat_params(self.ac.pi)
+        old_params = parameters_to_vector(self.ac.pi.parameters()).detach().clone()
         # update the old model, calculate KL divergence then decide whether to update new model
-        self.update_model(self.ac.pi_old, old_params)        
+        vector_to_parameters(old_params, self.ac.pi_old.parameters())
 
         if self.algo == 'npg':
             params = old_params + step_size * search_dir
-            self.update_model(self.ac.pi, params)
+            vector_to_parameters(params, self.ac.pi.parameters())
 
             kl = self.ac.pi.calculate_kl(new_policy=self.ac.pi, old_policy=self.ac.pi_old, obs=obs)
         elif self.algo == 'trpo':
-            # expected_improve = (gradient * step_size * search_dir).sum(0, keepdim=True)
-
-            for i in range(self.backtrack_iters):
-                # Backtracking line search
-                # (https://web.stanford.edu/~boyd/cvxbook/bv_cvxbook.pdf) 464p.
-                params = old_params + (self.backtrack_coeff**(i+1)) * step_size * search_dir
-                # params = old_params + self.backtrack_coeff * step_size * search_dir
-                self.update_model(self.ac.pi, params)
-
-
-                # Prediction logπ_old(s), logπ(s)
-                _, logp = self.ac.pi(obs, act)
-                
-                # Policy loss
-                ratio = torch.exp(logp - logp_old)
-                surrogate_adv = (ratio*adv).mean()
-
+            # Backtracking line search
+            # (https://web.stanford.edu/~boyd/cvxbook/bv_cvxbook.pdf) 464p.
+            # Every candidate step old_params + backtrack_coeff^(i+1) * step_size * search_dir is
+            # evaluated in a single vmap, the policy parameters are only written for the accepted step
+            alphas = self.backtrack_coeff ** torch.arange(1, self.backtrack_iters+1, dtype=torch.float32, device=self.device)
+            candidates = old_params + alphas[:, None] * step_size * search_dir
+
+            with torch.no_grad():
+                pi_old = self.ac.pi_old._distribution(obs)
+
+                def evaluate(flat_params):
+                    # Prediction logπ_old(s), logπ(s)
+                    pi, logp = functional_call(self.ac.pi, self.unflatten_params(self.ac.pi, flat_params), (obs, act))
+                    return logp, self.ac.pi._kl_from_distribution(pi_old, pi)
+
+                logp, kl = torch.vmap(evaluate)(candidates)
+                # Policy loss of every candidate, TorchScript functions can't run inside vmap
+                surrogate_adv = surrogate(logp, logp_old, adv)
                 improve = surrogate_adv - surrogate_adv_old
-                # expected_improve *= self.backtrack_coeff
-                # improve_condition = loss_improve / expected_improve
-
-                kl = self.ac.pi.calculate_kl(new_policy=self.ac.pi, old_policy=self.ac.pi_old, obs=obs)
-                
-                if kl <= self.delta and improve>0:
-                    print('Accepting new params at step %d of line search.'%i)
-                    # self.backtrack_iters.append(i)
-                    # log backtrack_iters=i
-                    break
-
-                if i == self.backtrack_iters-1:
-                    print('Line search failed! Keeping old params.')
-                    # self.backtrack_iters.append(i)
-                    # log backtrack_iters=i
-
-                    params = self.flat_params(self.ac.pi_old)
-                    self.update_model(self.ac.pi, params)
+                accepted = torch.nonzero((kl <= self.delta) & (improve > 0))
 
-                # self.backtrack_coeff *= 0.5
+            if len(accepted) > 0:
+                i = accepted[0].item()
+                print('Accepting new params at step %d of line search.'%i)
+                vector_to_parameters(candidates[i], self.ac.pi.parameters())
+            else:
+                print('Line search failed! Keeping old params.')
 
 
         # Update Critic
         for _ in range(self.train_v_iters):
-            self.v_optimizer.zero_grad()
-            v = self.ac.v(obs)
-            v_loss = ((v-ret)**2).mean()
+            self.v_optimizer.zero_grad(set_to_none=True)
+            with torch.autocast(device_type=self.device, dtype=torch.bfloat16, enabled=self.v_bf16):
+                v = self.v_train(obs)
+            v_loss = v_loss_fn(v.float(), ret)
             v_loss.backward()
             self.v_optimizer.step()
 
@@ -270,35 +315,38 @@ class TRPO:
         obs, ep_ret, ep_len = self.env.reset(), 0, 0
 
         for epoch in tqdm(range(epochs)):
-            for t in range(self.steps_per_epoch):
-                # step the environment
-                a, v, logp = self.ac.step(torch.as_tensor(obs, dtype=torch.float32).to(self.device))
-                next_obs, reward, done, _ = self.env.step(a)
-                ep_ret += reward
-                ep_len += 1
+            # no autograd bookkeeping is needed while collecting experience,
+            # everything stored into the buffer is converted to numpy first
+            with torch.inference_mode():
+                for t in range(self.steps_per_epoch):
+                    # step the environment
+                    a, v, logp = self.ac.step(self.obs_to_tensor(obs))
+                    next_obs, reward, done, _ = self.env.step(a)
+                    ep_ret += reward
+                    ep_len += 1
                 
-                # Add experience to buffer
-                self.buffer.store(obs, a, reward, v, logp)
-
-                obs = next_obs
-                timeout = ep_len == self.max_ep_len
-                terminal = done or timeout
-                epoch_ended = t==self.steps_per_epoch-1
-
-                # End of trajectory/episode handling
-                if terminal or epoch_ended:
-                    if timeout or epoch_ended:
-                        _, v, _ = self.ac.step(torch.as_tensor(obs, dtype=torch.float32).to(self.device))
-                    else:
-                        v = 0
+                    # Add experience to buffer
+                    self.buffer.store(obs, a, reward, v, logp)
+
+                    obs = next_obs
+                    timeout = ep_len == self.max_ep_len
+                    terminal = done or timeout
+                    epoch_ended = t==self.steps_per_epoch-1
+
+                    # End of trajectory/episode handling
+                    if terminal or epoch_ended:
+                        if timeout or epoch_ended:
+                            v = self.ac.v_only(self.obs_to_tensor(obs))
+                        else:
+                            v = 0
                     
-                    # print(f"Episode return: {ep_ret}")
-                    ep_rets.append(ep_ret)
-                    self.buffer.finish_path(v)
-                    # if terminal:
-                    #     # only save EpRet / EpLen if trajectory finished
-                    #     logger.store(EpRet=ep_ret, EpLen=ep_len)
-                    state, ep_ret, ep_len = self.env.reset(), 0, 0
+                        # print(f"Episode return: {ep_ret}")
+                        ep_rets.append(ep_ret)
+                        self.buffer.finish_path(v)
+                        # if terminal:
+                        #     # only save EpRet / EpLen if trajectory finished
+                        #     logger.store(EpRet=ep_ret, EpLen=ep_len)
+                        obs, ep_ret, ep_len = self.env.reset(), 0, 0
 
             # self.buffer.get()
             # update value function and TRPO policy update
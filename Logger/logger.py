@@ -2,33 +2,36 @@ import os
 import time
 import json
 import numpy as np
-import pickle
+import threading
+from collections import defaultdict
 
 class Logger:
     """
     A general-purpose logger.
     Simplify the saving of diagnostics, hyperparameter configurations, and the 
-    state of a training run. Saves the data in the form of a dictionary, and dumps them into a .json file
+    state of a training run. Saves the data in the form of a dictionary, and dumps them into a .npz file
     """
-    def __init__(self, output_dir=None, output_fname='progress.pickle'):
+    def __init__(self, output_dir=None, output_fname='progress.npz'):
         """
         Initialize a Logger.
         Args:
             output_dir (string): A directory for saving results to. If 
                 ``None``, defaults to a temp directory of the form
                 ``tmp/experiments/somerandomnumber``.
-            output_fname (string): Name for the tab-separated-value file 
+            output_fname (string): Name for the .npz file 
                 containing metrics logged throughout a training run. 
-                Defaults to ``progress.txt``. 
+                Defaults to ``progress.npz``. 
         """
         self.output_dir = output_dir or os.path.join("tmp", "experiments", f"{int(time.time())}")
         os.makedirs(self.output_dir, exist_ok=True)
 
         self.output_filepath = os.path.join(self.output_dir, output_fname)
-        self.logger_dict = {}
+        self.logger_dict = defaultdict(list)
         if os.path.isfile(self.output_filepath):
-            with open(self.output_filepath, 'rb') as f:
-                self.logger_dict = pickle.load(f)
+            with np.load(self.output_filepath, allow_pickle=False) as data:
+                for k in data.files:
+                    self.logger_dict[k] = list(data[k])
+        self._dump_thread = None
         
 
     def store(self, **kwargs):
@@ -38,27 +41,41 @@ class Logger:
         values.
         """
         for k, v in kwargs.items():
-            if not(k in self.logger_dict.keys()):
-                self.logger_dict[k] = []
             self.logger_dict[k].append(v)
 
     def dump(self):
         """
         Write all of the diagnostics from the current iteration.
-        Writes to the output file.
+        Writes a snapshot of the logger's state to the output file in a background thread,
+        waiting for the previous write to finish first.
         """
         # print(self.logger_dict)
-        with open(self.output_filepath, 'wb') as f:
-            pickle.dump(self.logger_dict, f)
+        snapshot = {k: list(v) for k, v in self.logger_dict.items()}
+        if self._dump_thread is not None:
+            self._dump_thread.join()
+        self._dump_thread = threading.Thread(target=self._write, args=(snapshot,))
+        self._dump_thread.start()
+
+    def _write(self, logger_dict):
+        """
+        Serialize logger_dict to a temporary file and move it over the output file,
+        so an interrupted write never leaves a truncated output file behind.
+        Each list of logged values is stored as one array in a compressed .npz archive.
+        """
+        arrs = {k: np.asarray(v) for k, v in logger_dict.items()}
+        tmp_filepath = self.output_filepath + '.tmp'
+        with open(tmp_filepath, 'wb') as f:
+            np.savez_compressed(f, **arrs)
+        os.replace(tmp_filepath, self.output_filepath)
 
     def load_results(self, keys):
         '''
-        return all the stored variables in the .json file
+        return all the stored variables in the .npz file
         Args:
             keys (list): list of keys to extract from logger
         '''
         output = []
         for key in keys:
-            assert key in self.logger_dict.keys(), "Attempted to get variables that are not stored in this .json file"
+            assert key in self.logger_dict.keys(), "Attempted to get variables that are not stored in this .npz file"
             output.append(self.logger_dict[key])
         return output
\ No newline at end of file